@@ -31,30 +31,59 @@ Modbus map for ecowatt signal (https://monecowatt.fr/)
 """
 
 import argparse
+from array import array
 import base64
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
 from datetime import datetime as dt
 from datetime import timedelta
 import logging
 from threading import Lock
 import time
-import json
-from urllib.error import URLError
-from urllib.request import urlopen, Request
+from zoneinfo import ZoneInfo
 # for ecowatt job: create an account on https://data.rte-france.com/
 # create an app (give you client and secret ids) and link it to ecowatt API endpoint
 from private_data import RTE_CLIENT_ID, RTE_SECRET_ID
-# sudo apt install python3-dateutil python3-tz
-from dateutil.parser import parse as dt_parse
-import pytz
 # sudo pip3 install 'pyModbusTCP>=0.2.0'
 from pyModbusTCP.server import ModbusServer, DataBank
+# sudo apt install python3-orjson python3-urllib3
+import orjson
+import urllib3
+
+
+# some const
+PARIS_TZ = ZoneInfo('Europe/Paris')
+DAY_OFFSETS = tuple(timedelta(days=d) for d in range(7))
+# HTTP connections pool: keep-alive connections are reused across jobs runs (avoid a TLS handshake at every poll)
+# retries only apply to connection/read errors: HTTP status replies (like 429 with Retry-After) are never
+# retried here, jobs handle them on their own schedule
+# timeouts ensure a hung server can't block a job thread forever
+HTTP_POOL = urllib3.PoolManager(maxsize=4,
+                                retries=urllib3.Retry(total=2, backoff_factor=0.5, respect_retry_after_header=False),
+                                timeout=urllib3.Timeout(connect=5.0, read=15.0))
 
 
 # some class
 class Share:
-    """A container to share modbus registers."""
+    """A container to share modbus registers and jobs stats.
+
+    Registers are published as an immutable snapshot: readers just grab the current reference (an atomic
+    operation) without any lock, writers build a patched copy and rebind it. The lock only serializes writers.
+    """
     lock = Lock()
-    v_hold_regs_d = {0: 0, 1: 0, 2: 0, 3: 4, 4: 5, 5: 0, 100: 0, 101: 0, 102: 0, 103: 0}
+    snapshot = array('H', [0] * 200)
+    http_cache_hits = 0
+    http_cache_misses = 0
+
+    @classmethod
+    def update(cls, address: int, values: list) -> None:
+        """Publish a new snapshot with registers at address overwritten by values."""
+        # build the write set outside the lock, then patch it in a single slice assignment
+        new_regs = array('H', values)
+        with cls.lock:
+            new_snap = array('H', cls.snapshot)
+            new_snap[address:address + len(new_regs)] = new_regs
+            cls.snapshot = new_snap
 
 
 class MyDataBank(DataBank):
@@ -68,47 +97,124 @@ class MyDataBank(DataBank):
     def get_holding_registers(self, address, number=1, srv_info=None):
         """Get virtual holding registers."""
         # build a list of virtual regs to return to server data handler
-        # return None if any of virtual registers is missing
-        try:
-            with Share.lock:
-                return [Share.v_hold_regs_d[a] for a in range(address, address + number)]
-        except KeyError:
+        # return None if any of virtual registers is out of the snapshot space
+        snap = Share.snapshot
+        if address + number > len(snap):
             return
+        return snap[address:address + number].tolist()
 
 
 # define jobs
 class Job:
     """Job skeleton."""
+    # jobs run on a shared thread pool, so a slow HTTP request never stalls the scheduler loop
+    executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='job')
 
     def __init__(self, every_s: int, runnable_now: bool = False, enable: bool = True) -> None:
         # public
         self.enable = enable
         self.every_s = every_s
         # private
-        self._last_run_t = float('-inf') if runnable_now else time.monotonic()
+        self._last_run_ns = time.monotonic_ns()
+        if runnable_now:
+            self._last_run_ns -= self._every_ns + 1
+        self._future = None
+
+    @property
+    def every_s(self) -> int:
+        return self._every_ns // 1_000_000_000
+
+    @every_s.setter
+    def every_s(self, value: int):
+        # scheduler use integer nanoseconds arithmetic
+        self._every_ns = int(value * 1_000_000_000)
 
     def update(self):
-        """Check if the run method should be executed and do-it."""
+        """Check if the run method should be executed and submit it to the executor."""
+        # skip while previous run is in progress
+        if self._future and not self._future.done():
+            return
         # job is runnable ?
-        if self.enable and (time.monotonic() - self._last_run_t) > self.every_s:
+        now_ns = time.monotonic_ns()
+        if self.enable and now_ns - self._last_run_ns > self._every_ns:
             logging.info(f'run {type(self).__name__}')
-            self._last_run_t = time.monotonic()
-            self.run()
+            self._last_run_ns = now_ns
+            self._future = self.executor.submit(self.run)
+            self._future.add_done_callback(self._on_run_done)
+
+    def retry_in(self, delay_s: float):
+        """Schedule the next run in delay_s seconds instead of every_s."""
+        self._last_run_ns = time.monotonic_ns() - self._every_ns + int(delay_s * 1_000_000_000)
+
+    def _on_run_done(self, future: Future):
+        """Log any exception unhandled by the run method (the executor would silently drop it)."""
+        exc = future.exception()
+        if exc:
+            logging.error(f'unhandled error in {type(self).__name__}: {exc!r}')
 
     def run(self):
         """Main job code this method must be overridden on the child."""
         pass
 
 
+class HttpJob(Job):
+    """Job skeleton with a cache for HTTP conditional requests (ETag/Last-Modified).
+
+    The last good parsed data is also kept to be served (stale) when a request fails.
+    """
+    # const
+    # delay before retry after a failed request (override it to match the server rate limit)
+    RETRY_S = 60
+    # private
+    _etag = None
+    _last_modified = None
+    _last_good = None
+
+    def _cache_headers(self) -> dict:
+        """Return the headers of a conditional request on the cached response (if any)."""
+        headers_d = {}
+        if self._last_good is not None:
+            if self._etag:
+                headers_d['if-none-match'] = self._etag
+            if self._last_modified:
+                headers_d['if-modified-since'] = self._last_modified
+        return headers_d
+
+    def _cache_load(self):
+        """Return the cached parsed data (on a 304 response)."""
+        # jobs run on several threads: += is not atomic
+        with Share.lock:
+            Share.http_cache_hits += 1
+        return self._last_good
+
+    def _cache_store(self, http_resp: urllib3.HTTPResponse, parsed) -> None:
+        """Store parsed data and validators of a 200 response."""
+        with Share.lock:
+            Share.http_cache_misses += 1
+        self._etag = http_resp.headers.get('etag')
+        self._last_modified = http_resp.headers.get('last-modified')
+        self._last_good = parsed
+
+    def _stale_load(self):
+        """Return the last good parsed data (or an empty dict) after a failed request and retry soon."""
+        logging.info(f'{type(self).__name__} keep last good data, retry in {self.RETRY_S}s')
+        self.retry_in(self.RETRY_S)
+        return self._last_good or {}
+
+
 class DebugJob(Job):
     """Debug task(s) job."""
 
     def run(self):
-        with Share.lock:
-            logging.debug(f'Share.v_hold_regs_d={Share.v_hold_regs_d}')
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        # lazy %-style formatting: repr is done only if the record is emitted
+        logging.debug('ecogaz regs @0=%s', Share.snapshot[0:6].tolist())
+        logging.debug('ecowatt regs @100=%s', Share.snapshot[100:104].tolist())
+        logging.debug('HTTP cache: hits=%d misses=%d', Share.http_cache_hits, Share.http_cache_misses)
 
 
-class EcogazJob(Job):
+class EcogazJob(HttpJob):
     """Retrieve ecogaz-signal data job."""
     # const
     API_URL = 'https://odre.opendatasoft.com/api/v2/catalog/datasets/signal-ecogaz/exports/' \
@@ -117,71 +223,109 @@ class EcogazJob(Job):
     def run(self):
         # HTTP request and data parse with errors handling
         odre_js_d = {}
+        success = False
         try:
-            # request
-            r = urlopen(self.API_URL)
-            # decode json message
-            odre_js_d_l = json.loads(r.read())
-            # convert data to dict with keys as python date
-            for odre_day_d in odre_js_d_l:
-                odre_js_d[dt_parse(odre_day_d['gas_day']).date()] = int(odre_day_d['indice_de_couleur'])
-        except URLError as e:
+            # request (conditional if a previous response is cached)
+            r = HTTP_POOL.request('GET', self.API_URL, headers=self._cache_headers())
+            if r.status == 304:
+                # not modified: skip json decode and parse
+                odre_js_d = self._cache_load()
+            elif r.status == 200:
+                # decode json message
+                odre_js_d_l = orjson.loads(r.data)
+                # convert data to dict with keys as python date
+                for odre_day_d in odre_js_d_l:
+                    day_date = date.fromisoformat(odre_day_d['gas_day'][:10])
+                    value = int(odre_day_d['indice_de_couleur'])
+                    # must fit in a modbus register
+                    if not 0 <= value <= 0xffff:
+                        raise ValueError(f'indice_de_couleur out of range: {value}')
+                    odre_js_d[day_date] = value
+                self._cache_store(r, odre_js_d)
+            else:
+                raise urllib3.exceptions.HTTPError(f'HTTP status {r.status}')
+            success = True
+        except urllib3.exceptions.HTTPError as e:
             logging.warning(f'network error in {type(self).__name__}: {e!r}')
-        except (json.decoder.JSONDecodeError, ValueError) as e:
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
             logging.warning(f'wrong data format in {type(self).__name__}: {e!r}')
-        # create a date dict with 5 days ahead and populate it with data from ODRE json
-        daily_d = {}
-        today_dt = dt.now(tz=pytz.timezone('Europe/Paris')).date()
-        for d_offset in range(6):
-            day_date = today_dt + timedelta(days=d_offset)
-            daily_d[day_date] = odre_js_d.get(day_date, 0)
-        # update modbus holding registers
-        with Share.lock:
-            for d_idx, date in enumerate(sorted(daily_d.keys())):
-                Share.v_hold_regs_d[d_idx] = daily_d.get(date)
+        # on failure, don't wipe registers: serve last good data
+        if not success:
+            odre_js_d = self._stale_load()
+        # update modbus holding registers with current day and 5 days ahead data from ODRE json
+        today_dt = dt.now(tz=PARIS_TZ).date()
+        Share.update(0, [odre_js_d.get(today_dt + DAY_OFFSETS[d_offset], 0) for d_offset in range(6)])
 
 
-class EcowattJob(Job):
+class EcowattJob(HttpJob):
     """Retrieve ecowatt-signal data job."""
     # const
     AUTH_SRV_URL = 'https://digital.iservices.rte-france.com/token/oauth/'
     RES_SRV_URL = 'https://digital.iservices.rte-france.com/open_api/ecowatt/v4/signals'
+    TOKEN_MARGIN_S = 60
+    # RTE allows 1 request every 15 min (HTTP 429 beyond), so a retry can't be sooner
+    RETRY_S = 900
+    # private
+    _token = None
+    _token_expires_at = 0.0
 
     def run(self):
         # HTTP request and data parse with errors handling
         fmt_js_d = {}
+        success = False
         try:
-            # 1st step: retrieve an access token from authorization server
-            auth_str = base64.b64encode(f'{RTE_CLIENT_ID}:{RTE_SECRET_ID}'.encode()).decode()
-            headers_d = {'authorization': f'Basic {auth_str}', 'content-type': 'application/x-www-form-urlencoded'}
-            http_resp = urlopen(Request(self.AUTH_SRV_URL, headers=headers_d, data=b''))
-            # decode json response
-            data_d = json.loads(http_resp.read())
-            token_value = data_d['access_token']
-            # token_expires_s = data_d['expires_in']
-            # token_type = data_d['token_type']
+            # 1st step: retrieve an access token from authorization server (reuse it until near its expiry)
+            if time.monotonic() < self._token_expires_at - self.TOKEN_MARGIN_S:
+                token_value = self._token
+            else:
+                auth_str = base64.b64encode(f'{RTE_CLIENT_ID}:{RTE_SECRET_ID}'.encode()).decode()
+                headers_d = {'authorization': f'Basic {auth_str}',
+                             'content-type': 'application/x-www-form-urlencoded'}
+                http_resp = HTTP_POOL.request('POST', self.AUTH_SRV_URL, headers=headers_d, body=b'')
+                if http_resp.status != 200:
+                    raise urllib3.exceptions.HTTPError(f'HTTP status {http_resp.status} on auth server')
+                # decode json response
+                data_d = orjson.loads(http_resp.data)
+                token_value = data_d['access_token']
+                # token_type = data_d['token_type']
+                self._token = token_value
+                self._token_expires_at = time.monotonic() + int(data_d['expires_in'])
             # 2nd step: retrieve ecowatt signal from resource server with the access token in request headers
-            http_resp = urlopen(Request(self.RES_SRV_URL, headers={'authorization': f'Bearer {token_value}'}))
-            # decode and show json data
-            raw_js_d = json.loads(http_resp.read())
-            # convert data to dict with keys as python date
-            for sig_day_d in raw_js_d['signals']:
-                fmt_js_d[dt_parse(sig_day_d['jour']).date()] = dict(value=int(sig_day_d['dvalue']),
-                                                                    message=sig_day_d['message'])
-        except URLError as e:
+            # (conditional if a previous response is cached)
+            headers_d = {'authorization': f'Bearer {token_value}', **self._cache_headers()}
+            http_resp = HTTP_POOL.request('GET', self.RES_SRV_URL, headers=headers_d)
+            if http_resp.status == 304:
+                # not modified: skip json decode and parse
+                fmt_js_d = self._cache_load()
+            elif http_resp.status == 200:
+                # decode and show json data
+                raw_js_d = orjson.loads(http_resp.data)
+                # convert data to dict with keys as python date
+                for sig_day_d in raw_js_d['signals']:
+                    day_date = dt.fromisoformat(sig_day_d['jour']).date()
+                    value = int(sig_day_d['dvalue'])
+                    # must fit in a modbus register
+                    if not 0 <= value <= 0xffff:
+                        raise ValueError(f'dvalue out of range: {value}')
+                    fmt_js_d[day_date] = dict(value=value, message=sig_day_d['message'])
+                self._cache_store(http_resp, fmt_js_d)
+            else:
+                # token rejected: request a new one at next run
+                if http_resp.status == 401:
+                    self._token_expires_at = 0.0
+                raise urllib3.exceptions.HTTPError(f'HTTP status {http_resp.status} on resource server')
+            success = True
+        except urllib3.exceptions.HTTPError as e:
             logging.warning(f'network error in {type(self).__name__}: {e!r}')
-        except (json.decoder.JSONDecodeError, ValueError, KeyError) as e:
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
             logging.warning(f'wrong data format in {type(self).__name__}: {e!r}')
-        # create a date dict with 3 days ahead and populate it with data from RTE json
-        daily_d = {}
-        today_dt = dt.now(tz=pytz.timezone('Europe/Paris')).date()
-        for offset in range(4):
-            day_date = today_dt + timedelta(days=offset)
-            daily_d[day_date] = fmt_js_d.get(day_date, dict(value=0, message=''))
-        # update modbus holding registers
-        with Share.lock:
-            for d_idx, date in enumerate(sorted(daily_d.keys())):
-                Share.v_hold_regs_d[100 + d_idx] = daily_d[date]['value']
+        # on failure, don't wipe registers: serve last good data
+        if not success:
+            fmt_js_d = self._stale_load()
+        # update modbus holding registers with current day and 3 days ahead data from RTE json
+        today_dt = dt.now(tz=PARIS_TZ).date()
+        Share.update(100, [fmt_js_d.get(today_dt + DAY_OFFSETS[d_offset], dict(value=0))['value']
+                           for d_offset in range(4)])
 
 
 if __name__ == '__main__':